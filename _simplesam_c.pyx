@@ -0,0 +1,141 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Optional compiled helpers for simplesam. Every function here has a pure
+Python equivalent that is used when this extension is not built.
+
+"""
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from libc.string cimport memchr, memcpy, memset
+
+cdef extern from "Python.h":
+    int PyUnicode_1BYTE_KIND
+    int PyUnicode_KIND(object o)
+    void *PyUnicode_DATA(object o)
+    Py_ssize_t PyUnicode_GET_LENGTH(object o)
+    object PyUnicode_Substring(object o, Py_ssize_t start, Py_ssize_t end)
+
+
+cdef int _op_mask(op):
+    """ Return 1 for operations that consume the reference, 2 for those that
+    consume the query and 3 for those that consume both. """
+    if op == 'M' or op == '=' or op == 'X' or op == 'EQ':
+        return 3
+    elif op == 'D' or op == 'N':
+        return 1
+    elif op == 'I' or op == 'S':
+        return 2
+    return 0
+
+
+cpdef bytes gapped_c(cigars, bytes ungapped, char gap):
+    """ Return ``ungapped`` with deletions from the reference filled with
+    ``gap`` and insertions removed, following the ``Sam.cigars`` tuples.
+    Aligned runs past the end of ``ungapped`` are truncated, as in the pure
+    Python ``Sam.gapped``. """
+    cdef Py_ssize_t i = 0, j = 0, n, k, length = 0
+    cdef Py_ssize_t size = len(ungapped)
+    cdef int mask
+    ops = []
+    for n, op in cigars:
+        mask = _op_mask(op)
+        ops.append((n, mask))
+        if mask & 1:
+            length += n
+    cdef bytes gapped = PyBytes_FromStringAndSize(NULL, length)
+    cdef char *dst = PyBytes_AS_STRING(gapped)
+    cdef const char *src = ungapped
+    for n, mask in ops:
+        if mask == 3:
+            k = min(n, size - i) if i < size else 0
+            memcpy(dst + j, src + i, k)
+            i += n
+            j += k
+        elif mask == 1:
+            memset(dst + j, gap, n)
+            j += n
+        elif mask == 2:
+            i += n
+    if j < length:
+        return gapped[:j]
+    return gapped
+
+
+def update_extractor_c(const unsigned char[:] seq not None, const unsigned char[:] qual not None,
+                       const unsigned char[:] ref not None, Py_ssize_t pos, unsigned char min_qual,
+                       unsigned char[:] refs not None, long[:] matches not None, list bases, list quals):
+    """ Add one read's gapped ``seq``/``qual`` starting at ``pos`` to the
+    ring-buffer columns of a pileup ``Extractor``. Bases at or below
+    ``min_qual`` are skipped. A column's reference base is taken from ``ref``
+    when it is first covered; bases differing from it are appended to the
+    column's ``bases``/``quals`` and matches are counted. """
+    cdef Py_ssize_t i, off
+    cdef Py_ssize_t capacity = refs.shape[0]
+    if qual.shape[0] != seq.shape[0]:
+        raise ValueError("The gapped quality and sequence differ in length.")
+    for i in range(seq.shape[0]):
+        if qual[i] <= min_qual:
+            continue
+        off = (pos + i) % capacity
+        if refs[off] == 0:
+            if i >= ref.shape[0]:
+                raise IndexError("index out of range")
+            refs[off] = ref[i]
+        if seq[i] != refs[off]:
+            bases[off].append(seq[i])
+            quals[off].append(qual[i])
+        else:
+            matches[off] += 1
+
+
+cdef object _parse_int(object line, const char *data, Py_ssize_t start, Py_ssize_t end):
+    """ Parse ``data[start:end]`` as a decimal integer, deferring to ``int()``
+    for anything other than an optional sign followed by up to 18 digits. """
+    cdef Py_ssize_t i = start
+    cdef long long value = 0
+    cdef bint negative = False
+    if i < end and (data[i] == 45 or data[i] == 43):  # '-' or '+'
+        negative = data[i] == 45
+        i += 1
+    if i == end or end - i > 18:
+        return int(PyUnicode_Substring(line, start, end))
+    while i < end:
+        if data[i] < 48 or data[i] > 57:
+            return int(PyUnicode_Substring(line, start, end))
+        value = value * 10 + (data[i] - 48)
+        i += 1
+    return -value if negative else value
+
+
+cpdef list split_sam_line(str line):
+    """ Return ``line.split('\\t', 11)`` with the FLAG, POS, MAPQ, PNEXT and
+    TLEN fields converted to int: the 11 mandatory SAM fields followed by
+    the tag fields, if any, as a single string. Tabs in one-byte (e.g. ASCII)
+    strings are located with ``memchr`` and integers are parsed in place,
+    without creating intermediate strings. """
+    cdef const char *data
+    cdef const char *tab
+    cdef Py_ssize_t size = PyUnicode_GET_LENGTH(line)
+    cdef Py_ssize_t start = 0, end
+    cdef int i = 0
+    cdef list fields
+    if PyUnicode_KIND(line) != PyUnicode_1BYTE_KIND:
+        fields = line.split('\t', 11)
+        for i in (1, 3, 4, 7, 8):
+            if i < len(fields):
+                fields[i] = int(fields[i])
+        return fields
+    data = <const char *>PyUnicode_DATA(line)
+    fields = []
+    while True:
+        tab = NULL
+        if i < 11:
+            tab = <const char *>memchr(data + start, 9, size - start)
+        end = size if tab == NULL else tab - data
+        if i == 1 or i == 3 or i == 4 or i == 7 or i == 8:
+            fields.append(_parse_int(line, data, start, end))
+        else:
+            fields.append(PyUnicode_Substring(line, start, end))
+        if tab == NULL:
+            return fields
+        start = end + 1
+        i += 1
@@ -0,0 +1,44 @@
+"""
+Optional Numba kernels for simplesam. When numba or numpy is not installed
+``ref_lengths`` is None and simplesam falls back to pure Python.
+
+"""
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = njit = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def cigar_ref_lengths(cigars, offsets):
+        """ Return the number of reference bases consumed by each CIGAR string in
+        the ASCII buffer ``cigars``, where string i is
+        ``cigars[offsets[i]:offsets[i + 1]]``. An unavailable CIGAR ('*') has
+        length 0. """
+        n = offsets.shape[0] - 1
+        lengths = np.zeros(n, dtype=np.int64)
+        for i in range(n):
+            total = 0
+            run = 0
+            for j in range(offsets[i], offsets[i + 1]):
+                c = cigars[j]
+                if 48 <= c <= 57:  # digit
+                    run = run * 10 + c - 48
+                else:
+                    if c == 77 or c == 68 or c == 78 or c == 61 or c == 88:  # M D N = X
+                        total += run
+                    run = 0
+            lengths[i] = total
+        return lengths
+
+    def ref_lengths(cigars):
+        """ Return a list with the reference length of each CIGAR string in the
+        list ``cigars``. """
+        buf = np.frombuffer(''.join(cigars).encode('ascii'), dtype=np.uint8)
+        offsets = np.zeros(len(cigars) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in cigars], out=offsets[1:])
+        return cigar_ref_lengths(buf, offsets).tolist()
+else:
+    cigar_ref_lengths = ref_lengths = None
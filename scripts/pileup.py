@@ -1,81 +1,334 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import argparse
 import pkg_resources
-from collections import deque
 from collections import Counter
-from collections import OrderedDict
+from array import array
+from multiprocessing import Pool
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
 
-class Extractor(OrderedDict):
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
-	def __missing__(self, pos):
-		value = (self.sam, deque(), deque())
-		self[pos] = value
-		return value
+try:
+	from _simplesam_c import update_extractor_c
+except ImportError:
+	update_extractor_c = None
+
+
+BUFFER_SIZE = 1 << 20
+TILE_WIDTH = 10000000
+BASES = ('A', 'C', 'T', 'G', 'N', '-')
+
+# maps each of BASES to its index and every other byte to len(BASES)
+_LANE_TABLE = bytes(bytearray(BASES.index(chr(i)) if chr(i) in BASES else len(BASES) for i in range(256)))
+
+if np is not None:
+	def lane_counts(seq):
+		""" Return the number of each of ``BASES`` in the bytes ``seq``, followed
+		by the number of any other bytes. """
+		lanes = np.frombuffer(seq.translate(_LANE_TABLE), dtype=np.uint8)
+		return np.bincount(lanes, minlength=len(BASES) + 1).tolist()
+else:
+	def lane_counts(seq):
+		""" Return the number of each of ``BASES`` in the bytes ``seq``, followed
+		by the number of any other bytes. """
+		counts = Counter(bytearray(seq.translate(_LANE_TABLE)))
+		return [counts[i] for i in range(len(BASES) + 1)]
+
+if np is not None:
+	def byte_counts(data):
+		""" Return a 256-lane histogram of the bytes in ``data``. """
+		return np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256).tolist()
+else:
+	def byte_counts(data):
+		""" Return a 256-lane histogram of the bytes in ``data``. """
+		counts = Counter(bytearray(data))
+		return [counts[b] for b in range(256)]
+
+
+class MismatchStats(object):
+	""" Tally, for each reference base, the bases observed over it. Mismatch
+	strings are buffered per reference base and histogrammed in bulk. """
+
+	def __init__(self):
+		self.counts = dict((b.encode('ascii'), [0] * 256) for b in BASES)
+		self.pending = dict((b.encode('ascii'), bytearray()) for b in BASES)
+
+	def update(self, ref, matches, mismatches):
+		self.counts[ref][ord(ref)] += matches
+		pending = self.pending[ref]
+		pending += mismatches
+		if len(pending) >= BUFFER_SIZE:
+			self._flush(ref)
+
+	def update_lanes(self, ref, matches, lanes):
+		""" Tally a column from its :func:`lane_counts` rather than its mismatch
+		string. Bytes outside ``BASES`` go to the NUL lane, which only
+		contributes to the total. """
+		counts = self.counts[ref]
+		counts[ord(ref)] += matches
+		for base, n in zip(BASES, lanes):
+			counts[ord(base)] += n
+		counts[0] += lanes[len(BASES)]
+
+	def _flush(self, ref):
+		counts = self.counts[ref]
+		for b, n in enumerate(byte_counts(self.pending[ref])):
+			counts[b] += n
+		del self.pending[ref][:]
+
+	def merge(self, other):
+		""" Add the tallies of another :class:`MismatchStats` to this one. """
+		for ref in other.counts:
+			other._flush(ref)
+			self._flush(ref)
+			self.counts[ref] = [a + b for a, b in zip(self.counts[ref], other.counts[ref])]
+
+	def write(self, out):
+		for ref in sorted(self.counts):
+			self._flush(ref)
+			counts = self.counts[ref]
+			ref = ref.decode('ascii')
+			for base in BASES:
+				ref_count = counts[ord(ref)]
+				base_count = counts[ord(base)]
+				try:
+					percent_base = base_count / sum(counts)
+				except ZeroDivisionError:
+					percent_base = 0.
+				out.write('{ref}\t{base}\t{ref_count}\t{base_count}\t{percent_base:.4%}\n'.format(**locals()))
+
+
+class Extractor(object):
+	""" Struct-of-arrays ring buffer of pileup columns. The column for genomic
+	position ``pos`` lives at offset ``pos % capacity`` and is live while
+	``window_start <= pos < end``.
+
+	Reads arrive in coordinate order and ``clear`` is called up to each read's
+	start, so the live window is always a single covered run: uncovered
+	stretches between reads are never swept, and once the window empties it is
+	rebased at the start of the next read.
+
+	Each column takes its reference base from the first read that covers it,
+	and every base piled onto the column is compared with that base, so a
+	spliced read's skipped region counts as a gap against the reference:
+
+	>>> from simplesam import Sam
+	>>> full = Sam('a', 0, 'c1', 1, 60, '50M', seq='A' * 50, qual='I' * 50, tags=['MD:Z:50'])
+	>>> spliced = Sam('b', 0, 'c1', 1, 60, '10M30N10M', seq='A' * 20, qual='I' * 20, tags=['MD:Z:20'])
+	>>> e = Extractor()
+	>>> e.update(full, '!')
+	>>> e.update(spliced, '!')
+	>>> e.matches[10], e.matches[11], bytes(e.bases[11])
+	(2, 1, b'-')
+
+	Reads without base qualities cannot be piled up:
+
+	>>> e.update(Sam('c', 0, 'c1', 1, 60, '10M', seq='A' * 10, qual='*', tags=['MD:Z:10']), '!')
+	Traceback (most recent call last):
+	...
+	ValueError: The length of the 'qual' attribute is not equal to the length of Sam.seq!
+	"""
+
+	def __init__(self, capacity=1024, counts_only=False):
+		self.counts_only = counts_only
+		self.rname = None
+		self.window_start = 0
+		self.end = 0
+		self._allocate(capacity)
+
+	def _allocate(self, capacity):
+		self.capacity = capacity
+		self.refs = bytearray(capacity)
+		self.matches = array('l', [0]) * capacity
+		self.bases = [bytearray() for _ in range(capacity)]
+		self.quals = [bytearray() for _ in range(capacity)]
+
+	def _grow(self, span):
+		refs, matches, bases, quals, capacity = self.refs, self.matches, self.bases, self.quals, self.capacity
+		new_capacity = capacity
+		while new_capacity < span:
+			new_capacity *= 2
+		self._allocate(new_capacity)
+		for pos in range(self.window_start, self.end):
+			old, new = pos % capacity, pos % new_capacity
+			self.refs[new] = refs[old]
+			self.matches[new] = matches[old]
+			self.bases[new] = bases[old]
+			self.quals[new] = quals[old]
 
 	def update(self, sam, min_qual):
-		self.sam = sam
 		g = sam.pos
-		for i, (seq, qual) in enumerate(zip(sam.gapped('seq', '-'), sam.gapped('qual', '~'))):
-			if qual > min_qual:
-				self[g + i][1].append(seq)
-				self[g + i][2].append(qual)
+		if self.end <= self.window_start:
+			self.window_start = self.end = g
+		if sam.rname != self.rname:
+			self.rname = sam.rname
+			self._rname = sam.rname.encode('ascii')
+		ref = sam._md_ref()
+		end = g + len(ref)
+		if end - self.window_start > self.capacity:
+			self._grow(end - self.window_start)
+		refs, matches, bases, quals, capacity = self.refs, self.matches, self.bases, self.quals, self.capacity
+		seq, qual = sam._gapped_pair('-', '~')
+		if qual is None:
+			raise ValueError("The length of the 'qual' attribute is not equal to the length of Sam.seq!")
+		if update_extractor_c is not None:
+			update_extractor_c(seq, qual, ref, g, ord(min_qual), refs, matches, bases, quals)
+			self.end = max(self.end, end)
+			return
+		min_qual = ord(min_qual)
+		for i in range(len(seq)):
+			q = qual[i]
+			if q <= min_qual:
+				continue
+			off = (g + i) % capacity
+			if not refs[off]:
+				refs[off] = ref[i]
+			base = seq[i]
+			if base != refs[off]:
+				bases[off].append(base)
+				quals[off].append(q)
+			else:
+				matches[off] += 1
+		self.end = max(self.end, end)
 
 	def clear(self, stop=None):
-		for pos in sorted(k for k in self.keys() if stop is not None and k < stop):
-			sam, seq, qual = self.pop(pos)
-			ref = sam.parse_md()[sam.index_of(pos)]
+		""" Yield and reset every covered column before ``stop``, or all
+		columns if ``stop`` is None. """
+		if stop is not None and stop <= self.window_start:
+			return
+		end = self.end if stop is None else min(stop, self.end)
+		refs, matches, bases, quals, capacity = self.refs, self.matches, self.bases, self.quals, self.capacity
+		for pos in range(self.window_start, end):
+			off = pos % capacity
+			if not refs[off]:
+				continue
+			seq, qual = bases[off], quals[off]
+			if self.counts_only:
+				yield (self._rname, b'%d' % pos, bytes(refs[off:off + 1]), b'%d' % matches[off], b'%d' % len(seq), lane_counts(seq))
+			else:
+				yield (self._rname, b'%d' % pos, bytes(refs[off:off + 1]), b'%d' % matches[off], b'%d' % len(seq), bytes(seq), bytes(qual))
+			refs[off] = 0
+			matches[off] = 0
+			del seq[:]
+			del qual[:]
+		self.window_start = max(self.window_start, end if stop is None else stop)
+
+
+def columns(bam, e):
+	""" Yield the pileup columns of the mapped, primary, non-duplicate reads in ``bam``. """
+	for read in bam:
+		if not read.mapped:
+			continue
+		if read.duplicate:
+			continue
+		if read.secondary:
+			continue
+		if read.rname != e.rname:
+			for line in e.clear():
+				yield line
+		elif read.pos > e.window_start:
+			for line in e.clear(stop=read.pos):
+				yield line
+		e.update(read, '!')
+
+	for line in e.clear():
+		yield line
+
+
+def region_columns(bam, region, e):
+	""" Yield the pileup columns of ``bam`` that fall inside the UCSC-style ``region``. """
+	start, end = [int(x) for x in region.rsplit(':', 1)[1].split('-')]
+	for line in columns(bam, e):
+		pos = int(line[1])
+		if pos > end:
+			break
+		if pos >= start:
+			yield line
+
+
+def write_columns(lines, out, counts=False, stats=None, counts_only=False):
+	""" Write pileup ``lines`` to the binary file ``out`` in ``BUFFER_SIZE``
+	chunks, tallying them into ``stats`` if it is given. With ``counts_only``
+	the lines come from a counts-only :class:`Extractor`. """
+	buf = bytearray()
+	for line in lines:
+		if counts_only:
+			buf += b'\t'.join(line[:5] + tuple(b'%d' % c for c in line[5][:len(BASES)])) + b'\n'
+		elif counts:
+			buf += b'\t'.join(line + tuple(b'%d' % c for c in lane_counts(line[5])[:len(BASES)])) + b'\n'
+		else:
+			buf += b'\t'.join(line) + b'\n'
+		if len(buf) >= BUFFER_SIZE:
+			out.write(buf)
+			del buf[:]
+		if stats is None:
+			pass
+		elif counts_only:
+			stats.update_lanes(line[2], int(line[3]), line[5])
+		else:
+			stats.update(line[2], int(line[3]), line[5])
+	out.write(buf)
+
+
+def pileup_region(task):
+	""" Pile up one region into a temporary file. Returns the file name and the
+	region's :class:`MismatchStats` (or None). """
+	from simplesam import Reader
+
+	bam_name, region, counts, counts_only, tally = task
+	stats = MismatchStats() if tally else None
+	with open(bam_name) as f, Reader(f, regions=region) as bam:
+		with NamedTemporaryFile(suffix='.pileup', delete=False) as out:
 			try:
-				s, q = zip(*[(s, q) for s, q in zip(seq, qual) if s != ref])
-			except ValueError:
-				s, q = ([], [])
-			yield (sam.rname, str(pos), ref, str(len(seq) - len(s)), str(len(s)), ''.join(s), ''.join(q))
+				lines = region_columns(bam, region, Extractor(counts_only=counts_only))
+				write_columns(lines, out, counts, stats, counts_only)
+			except BaseException:
+				out.close()
+				os.remove(out.name)
+				raise
+	return out.name, stats
 
 
 def pileup(args):
 	from simplesam import Reader
 
-	e = Extractor()
-	bases = ('A', 'C', 'T', 'G', 'N', '-')
-	stats = dict([('A', Counter()), ('C', Counter()), ('T', Counter()), ('G', Counter()), ('N', Counter()), ('-', Counter())])
-	with Reader(args.bam) as bam:
-		for read in bam:
-			if not read.mapped:
-				continue
-			if read.duplicate:
-				continue
-			if read.secondary:
-				continue
-			for line in e.clear(stop=read.pos):
-				if args.counts:
-					args.pileup.write('\t'.join(line) + '\t' + '\t'.join([str(line[5].count(c)) for c in bases]) + '\n')
-				else:
-					args.pileup.write('\t'.join(line) + '\n')
-				if args.stats:
-					stats[line[2]][line[2]] += int(line[3])
-					stats[line[2]].update(line[5])
-			e.update(read, '!')
-
-		for line in e.clear():
-			if args.counts:
-				args.pileup.write('\t'.join(line) + '\t' + '\t'.join([str(line[5].count(c)) for c in bases]) + '\n')
-			else:
-				args.pileup.write('\t'.join(line) + '\n')
-			if args.stats:
-				stats[line[2]][line[2]] += int(line[3])
-				stats[line[2]].update(line[5])
-
-		if args.stats:
-			for ref, counts in sorted(stats.items()):
-				for base in bases:
-					ref_count = counts[ref]
-					base_count = counts[base]
-					try:
-						percent_base = base_count / sum(counts.values())
-					except ZeroDivisionError:
-						percent_base = 0.
-					args.stats.write('{ref}\t{base}\t{ref_count}\t{base_count}\t{percent_base:.4%}\n'.format(**locals()))
+	stats = MismatchStats() if args.stats else None
+	if args.threads > 1:
+		with Reader(args.bam) as bam:
+			regions = list(bam.tile_genome(TILE_WIDTH))
+		if regions:
+			with Reader(args.bam, regions=regions[0]):
+				pass  # index the BAM once here rather than racing in the workers
+		tasks = [(args.bam.name, region, args.counts, args.counts_only, stats is not None) for region in regions]
+		pool = Pool(args.threads)
+		name = None
+		try:
+			for name, region_stats in pool.imap(pileup_region, tasks):
+				with open(name, 'rb') as f:
+					copyfileobj(f, args.pileup)
+				os.remove(name)
+				name = None
+				if stats is not None:
+					stats.merge(region_stats)
+		finally:
+			if name is not None:
+				os.remove(name)
+			pool.terminate()
+			pool.join()
+	else:
+		with Reader(args.bam) as bam:
+			lines = columns(bam, Extractor(counts_only=args.counts_only))
+			write_columns(lines, args.pileup, args.counts, stats, args.counts_only)
+
+	if stats is not None:
+		stats.write(args.stats)
 
 
 def main():
@@ -83,12 +336,16 @@ def main():
 	parser.add_argument('--version', action='version', version="%(prog)s version {0}".format(pkg_resources.get_distribution("simplesam").version))
 
 	parser.add_argument('bam', type=argparse.FileType('r'), help="sorted/indexed BAM file ")
-	parser.add_argument('pileup', type=argparse.FileType('w'), help="pileup output file")
+	parser.add_argument('pileup', type=argparse.FileType('wb'), help="pileup output file")
 	parser.add_argument('-c', '--counts', action='store_true', default=False, help="display counts for A/C/T/G/N/- separately (default: %(default)s)")
+	parser.add_argument('--counts-only', action='store_true', default=False, help="replace the mismatch base and quality columns with the A/C/T/G/N/- counts (default: %(default)s)")
 	parser.add_argument('-i', '--stats', type=argparse.FileType('w'), help="tabulate mismatches to output file")
+	parser.add_argument('-t', '--threads', type=int, default=1, help="number of worker processes, each piling up separate genomic regions (default: %(default)s)")
 	parser.set_defaults(func=pileup)
 
 	args = parser.parse_args()
+	if args.threads > 1 and not args.bam.name.lower().endswith('.bam'):
+		parser.error("--threads requires a BAM file, since regions are read through the BAM index")
 	args.func(args)
 
 if __name__ == "__main__":
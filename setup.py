@@ -1,5 +1,34 @@
-from setuptools import setup
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
 import os.path
+import sys
+
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('_simplesam_c', ['_simplesam_c.pyx'])])
+except ImportError:  # the compiled helpers are optional
+    ext_modules = []
+
+
+class optional_build_ext(build_ext):
+    """ Build the compiled helpers if possible; simplesam falls back to pure
+    Python when they are missing, so a failed build is not fatal. """
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError as e:  # no C compiler
+            self._warn(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+            self._warn(e)
+
+    def _warn(self, error):
+        sys.stderr.write("warning: building the optional C extension failed (%s); "
+                         "installing the pure Python version\n" % error)
 
 setup(
     name='simplesam',
@@ -21,7 +50,10 @@ setup(
                 "Programming Language :: Python :: 3.10",
                 "Topic :: Scientific/Engineering :: Bio-Informatics",
                 ],
-    py_modules=['simplesam'],
+    py_modules=['simplesam', '_simplesam_numba'],
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
     scripts=['scripts/pileup.py'],
-    install_requires=['six', 'ordereddict']
+    install_requires=['six', 'ordereddict'],
+    extras_require={'pysam': ['pysam']}
 )
\ No newline at end of file
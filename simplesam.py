@@ -15,11 +15,14 @@ except ImportError: #python 2.6 or 3.6+
         from ordereddict import OrderedDict
 
 import os
-from itertools import groupby
 from subprocess import Popen, PIPE
-from io import TextIOWrapper
+import codecs
+from itertools import chain, islice
+from array import array
 import re
-from six import PY3, string_types
+import threading
+from six import string_types
+from six.moves import queue, zip_longest
 from pkg_resources import get_distribution
 
 try:
@@ -27,8 +30,45 @@ try:
 except ImportError: #python2
     from _multiprocessing import Connection
 
+try:
+    from _simplesam_c import gapped_c, split_sam_line
+except ImportError:  # the compiled extension is optional
+    gapped_c = split_sam_line = None
+
+try:
+    import pysam
+except ImportError:  # fall back to a samtools subprocess for BAM reading
+    pysam = None
+
 __version__ = get_distribution("simplesam").version
 
+# the mandatory SAM fields, in column order
+_SAM_FIELDS = ('qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual')
+_SAM_INT_FIELDS = frozenset(('flag', 'pos', 'mapq', 'pnext', 'tlen'))
+
+# one SAM record; the tag fields carry their own leading tab. Integer fields
+# use %s too, so a field assigned as a string (e.g. sam.tlen = '5') is written as is
+_SAM_FMT = '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s%s\n'
+
+# converters for SAM tag data by type code; 'A' is just a single character
+_TAG_CONV = {'i': int, 'f': float, 'Z': str, 'A': str}
+
+# tag templates for the exact Python types; subclasses go through isinstance
+_ENCODERS = {str: '%s:Z:%s', int: '%s:i:%d', float: '%s:f:%r'}
+
+# buffer and read size for samtools pipes
+_PIPE_BUFSIZE = 1 << 20
+
+_CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+_MD_RE = re.compile(br'([0-9]+)\^?([A-Z]+)?')
+
+# CIGAR operation classes indexed by ord(op): bit 0 consumes the reference,
+# bit 1 consumes the query and bit 2 is not part of the alignment
+_OP_MASK = bytearray(256)
+for _op, _mask in (('M', 3), ('=', 3), ('X', 3), ('D', 1), ('N', 1), ('I', 2), ('S', 2), ('H', 4), ('P', 4)):
+    _OP_MASK[ord(_op)] = _mask
+
+
 class DefaultOrderedDict(OrderedDict):
     def __init__(self, default, items=[]):
         super(DefaultOrderedDict, self).__init__(items)
@@ -39,7 +79,53 @@ class DefaultOrderedDict(OrderedDict):
         return value
 
 
+class _TagDict(dict):
+    """ Parsed SAM tags. Keeps the encoded tag fields once they are built and
+    drops them whenever the tags are modified. Built from a plain dict by
+    :func:`parse_sam_tags`, so parsing does not go through the wrapped
+    mutators. """
+    __slots__ = ('_encoded',)
+
+    def __reduce__(self):
+        return (_restore_tags, (dict(self), self._encoded))
+
+    def encoded(self):
+        """ Return the tags as tab-delimited fields sorted by tag name, unless
+        they are unmodified since they were parsed. """
+        if self._encoded is None:
+            self._encoded = '\t'.join([encode_tag(tag, self[tag]) for tag in sorted(self)])
+        return self._encoded
+
+    def _modified(method):
+        def wrapper(self, *args, **kwargs):
+            self._encoded = None
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    __setitem__ = _modified(dict.__setitem__)
+    __delitem__ = _modified(dict.__delitem__)
+    clear = _modified(dict.clear)
+    pop = _modified(dict.pop)
+    popitem = _modified(dict.popitem)
+    setdefault = _modified(dict.setdefault)
+    update = _modified(dict.update)
+    if hasattr(dict, '__ior__'):  # python 3.9+
+        __ior__ = _modified(dict.__ior__)
+    del _modified
+
+
+def _restore_tags(items, encoded):
+    """ Unpickle a :class:`_TagDict` along with its encoded fields. """
+    tags = _TagDict(items)
+    tags._encoded = encoded
+    return tags
+
+
 class GenomicOrder(object):
+    __slots__ = ()
+
     def __gt__(self, other):
         if self.rname != other.rname:
             return self.rname > other.rname
@@ -55,10 +141,13 @@ class GenomicOrder(object):
 
 
 class Reader(object):
-    """ Read SAM/BAM format file as an iterable. """
-    def __init__(self, f, regions=False, kind=None, samtools_path="samtools"):
+    """ Read SAM/BAM format file as an iterable. BAM files are decompressed
+    on ``samtools_threads`` extra threads, through pysam when it is installed
+    and ``samtools view`` otherwise. """
+    def __init__(self, f, regions=False, kind=None, samtools_path="samtools", samtools_threads=2):
         ext = None
         self.samtools_path = samtools_path
+        self.samtools_threads = samtools_threads
         self.spool = None  # use this to catch alignment during reader scraping
         self.type = 'sam'
         try:
@@ -93,9 +182,17 @@ class Reader(object):
                 break
         self.header_as_dict(header)
         self.f = iter(f.recv, '')
+        self._lines = (line[:-1] if line[-1:] == '\n' else line for line in self.f)
         self._conn = 'pipe'
 
     def _sam_init(self, f):
+        """ Read the header from a SAM file object, or from any other iterable
+        of SAM lines; the latter are iterated line by line.
+
+        >>> lines = ['@HD\\tVN:1.0\\n', 'r1\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n', 'r2\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n']
+        >>> [sam.qname for sam in Reader(line for line in lines)]
+        ['r1', 'r2']
+        """
         header = []
         self.f = f
         for line in self.f:
@@ -105,21 +202,26 @@ class Reader(object):
                 self.spool = line
                 break
         self.header_as_dict(header)
+        if hasattr(self.f, 'read'):
+            self._lines = self._chunk_iter()
+        else:  # any other iterable of lines
+            self._lines = (line.rstrip('\n\r') for line in self.f)
         self._conn = 'file'
 
     def _bam_init(self, f, regions):
+        if pysam is not None:
+            self._pysam_init(f, regions)
+            return
         pline = [self.samtools_path, 'view', '-H', f.name]
         try:
-            p = Popen(pline, bufsize=-1, stdout=PIPE,
+            p = Popen(pline, bufsize=_PIPE_BUFSIZE, stdout=PIPE,
                       stderr=PIPE)
         except OSError:
             raise OSError('Samtools must be installed for BAM file support!\n')
         self.header_as_dict([line.decode('utf-8').rstrip('\n\r') for line in p.stdout])
         p.wait()
         if regions:
-            try:
-                open(''.join([f.name, '.bai']))
-            except EnvironmentError:
+            if not bam_index_exists(f.name):
                 sys.stderr.write("BAM index not found. Attempting to index file.\n")
                 index_p = Popen([self.samtools_path, 'index', f.name], stdout=PIPE, stderr=PIPE)
 
@@ -128,32 +230,82 @@ class Reader(object):
                     raise OSError("Indexing failed. Is the BAM file sorted?\n")
                 else:
                     sys.stderr.write("Index created successfully.\n")
-            pline = [self.samtools_path, 'view', f.name, regions]
+            pline = [self.samtools_path, 'view', '-@', str(self.samtools_threads), f.name, regions]
         else:
-            pline = [self.samtools_path, 'view', f.name]
-        self.p = Popen(pline, bufsize=-1, stdout=PIPE,
+            # without a region samtools streams the file start to finish,
+            # without an index or per-record region checks
+            pline = [self.samtools_path, 'view', '-@', str(self.samtools_threads), f.name]
+        self.p = Popen(pline, bufsize=_PIPE_BUFSIZE, stdout=PIPE,
                   stderr=PIPE)
-        if PY3:
-            self.f = TextIOWrapper(self.p.stdout)
-        else:
-            self.f = self.p.stdout
-
+        self.f = self.p.stdout
+        # decode and split samtools output on a background thread, so reading
+        # the pipe overlaps with building records on this one
+        self._queue = queue.Queue(maxsize=64)
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=_read_blocks, args=(self.f, self._queue, self._stop))
+        self._reader.daemon = True
+        self._reader.start()
+        self._lines = self._queue_iter()
         self._conn = 'proc'
 
+    def _pysam_init(self, f, regions):
+        self._bam = pysam.AlignmentFile(f.name, 'rb', threads=self.samtools_threads)
+        self.header_as_dict(str(self._bam.header).splitlines())
+        if regions:
+            if not self._bam.has_index():
+                sys.stderr.write("BAM index not found. Attempting to index file.\n")
+                try:
+                    pysam.index(f.name)
+                except pysam.SamtoolsError:
+                    raise OSError("Indexing failed. Is the BAM file sorted?\n")
+                sys.stderr.write("Index created successfully.\n")
+                self._bam.close()
+                self._bam = pysam.AlignmentFile(f.name, 'rb', threads=self.samtools_threads)
+            self.f = self._bam.fetch(region=regions)
+        else:
+            # stream every record in file order, skipping the index entirely
+            self.f = self._bam.fetch(until_eof=True)
+        self._conn = 'pysam'
+
+    def _chunk_iter(self, chunk_size=1 << 20):
+        """ Yield lines from ``self.f``, without line terminators, reading
+        ``chunk_size`` characters at a time. """
+        remainder = ''
+        while True:
+            chunk = self.f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+    def _queue_iter(self):
+        """ Yield lines from the blocks queued by the background reader. """
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            for line in block:
+                yield line
+
     def next(self):
         """ Returns the next :class:`.Sam` object """
+        if self._conn == 'pysam':
+            return segment_to_sam(next(self.f))
         try:
             if self.spool:  # this will be the first alignment in a SAM file or stream
                 line = self.spool.rstrip('\n\r')
                 self.spool = None
             else:
-                line = next(self.f).rstrip('\n\r')
+                line = next(self._lines)
             if line == '':
                 raise StopIteration
-            fields = line.split('\t')
-            required = fields[:11]
-            tags = fields[11:]
-            return Sam(*required, tags=tags)
+            return Sam.from_line(line)
         except StopIteration:
             raise StopIteration
 
@@ -168,22 +320,121 @@ class Reader(object):
         Not implemented for SAM files. """
         if self.type != 'bam':
             raise NotImplementedError("len(Reader) is only implemented for BAM files.")
+        elif self._conn == 'pysam':
+            return self._bam.mapped + self._bam.unmapped
         elif self.type == 'bam':
             return sum(bam_read_count(self._f_name, self.samtools_path))
 
+    def iter_batches(self, n=65536):
+        """ Returns an iterator over the remaining records in batches of up
+        to ``n``, without building :class:`.Sam` objects. Each batch is a dict
+        of columns keyed by SAM field name: ``array('l')`` for the integer
+        fields, lists of strings for the others, and under ``'tags'`` the tag
+        fields of each record as one tab-delimited string ('' if it has none).
+        Lines are split 256 at a time and transposed into the columns, so
+        the per-line field lists are freed before the next lines are read.
+
+        >>> import io
+        >>> sam = io.StringIO('@SQ\\tSN:c1\\tLN:100\\n'
+        ...                   'r1\\t0\\tc1\\t1\\t60\\t4M\\t*\\t0\\t0\\tACGT\\tIIII\\tNM:i:0\\n'
+        ...                   'r2\\t16\\tc1\\t5\\t30\\t4M\\t*\\t0\\t0\\tTTTT\\t*\\n'
+        ...                   'r3\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n')
+        >>> batches = list(Reader(sam).iter_batches(2))
+        >>> [batch['qname'] for batch in batches]
+        [['r1', 'r2'], ['r3']]
+        >>> list(batches[0]['pos']), batches[0]['tags'], batches[1]['tags']
+        ([1, 5], ['NM:i:0', ''], [''])
+        """
+        if self._conn == 'pysam':
+            lines = (segment.to_string() for segment in self.f)
+        else:
+            lines = self._text_lines()
+        names = _SAM_FIELDS + ('tags',)
+        while True:
+            batch = dict((name, []) for name in names)
+            columns = [batch[name] for name in names]
+            remaining = n
+            while remaining > 0:
+                chunk = list(islice(lines, min(remaining, 256)))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if split_sam_line is not None:
+                    rows = [split_sam_line(line) for line in chunk if line]
+                else:
+                    rows = [line.split('\t', 11) for line in chunk if line]
+                for column, values in zip(columns, zip_longest(*rows, fillvalue='')):
+                    column.extend(values)
+                tags = columns[11]
+                if len(tags) < len(columns[0]):  # no line in the chunk had tags
+                    tags.extend([''] * (len(columns[0]) - len(tags)))
+            if not columns[0]:
+                return
+            for name in _SAM_INT_FIELDS:
+                column = batch[name]
+                batch[name] = array('l', column if split_sam_line is not None else list(map(int, column)))
+            yield batch
+
+    def batch_ref_lengths(self, n=100000):
+        """ Returns an iterator over the remaining records in batches of up
+        to ``n``, yielding a list with the reference length (``len(sam)``) of
+        each record in the batch. The lengths are computed by a single Numba
+        kernel per batch when numba is installed.
+
+        >>> import io
+        >>> sam = io.StringIO('r1\\t0\\tc1\\t1\\t60\\t8M2I4M1D3M\\t*\\t0\\t0\\t*\\t*\\n'
+        ...                   'r2\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n')
+        >>> list(Reader(sam).batch_ref_lengths())
+        [[16, 0]]
+        """
+        try:
+            from _simplesam_numba import ref_lengths
+        except ImportError:  # simplesam.py used without its sibling modules
+            ref_lengths = None
+        while True:
+            batch = list(islice(self, n))
+            if not batch:
+                return
+            if ref_lengths is None:
+                yield [len(sam) for sam in batch]
+            else:
+                yield ref_lengths([sam.cigar for sam in batch])
+
     def subsample(self, n):
         """ Returns an interator that draws every nth read from
-        the input file. Returns :class:`.Sam`. """
-        for i, line in enumerate(self.f):
-            if i % n == 0:
-                fields = line.split('\t')
-                required = fields[:11]
-                tags = fields[11:]
-                yield Sam(*required, tags=tags)
+        the input file. Returns :class:`.Sam`. The first alignment, which is
+        held back while the header is read, is always drawn.
+
+        >>> import io
+        >>> sam = io.StringIO('@SQ\\tSN:c1\\tLN:100\\n' + ''.join(
+        ...     'r%d\\t4\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t*\\t*\\n' % i for i in range(1, 8)))
+        >>> [sam.qname for sam in Reader(sam).subsample(3)]
+        ['r1', 'r4', 'r7']
+        """
+        if self._conn == 'pysam':
+            for segment in islice(self.f, 0, None, n):
+                yield segment_to_sam(segment)
+            return
+        for line in islice(self._text_lines(), 0, None, n):
+            if line:
+                yield Sam.from_line(line)
+
+    def _text_lines(self):
+        """ Return an iterator over the remaining SAM lines, starting with the
+        spooled first alignment if it has not been read yet. """
+        if self.spool:
+            lines = chain([self.spool.rstrip('\n\r')], self._lines)
+            self.spool = None
+            return lines
+        return self._lines
 
     def header_as_dict(self, header):
-        """ Parse the header list and return a nested dictionary. """
+        """ Parse the header list and return a nested dictionary. The @SQ
+        names and lengths are also kept, in header order, for :attr:`seqs`
+        and :meth:`tile_genome`. """
         self.header = DefaultOrderedDict(OrderedDict)
+        sq_names = []
+        sq_lengths = []
         for line in header:
             line = line.split('\t')
             key, fields = (line[0], line[1:])
@@ -191,20 +442,22 @@ class Reader(object):
                 self.header[key][fields[0]] = fields[1:]
             except IndexError:
                 self.header[key][fields[0]] = ['']
+            if key == '@SQ':
+                sq_names.append(fields[0].split(':', 1)[1])
+                sq_lengths.append(next((int(f[3:]) for f in fields[1:] if f.startswith('LN:')), 0))
+        self._sq_names = tuple(sq_names)
+        self._sq_lengths = tuple(sq_lengths)
 
     @property
     def seqs(self):
         """ Return just the sequence names from the @SQ library as a generator. """
-        for key in self.header['@SQ'].keys():
-            yield key.split(':')[1]
+        return iter(self._sq_names)
 
     def tile_genome(self, width):
         """ Return a generator of UCSC-style regions tiling ``width``. """
         assert isinstance(width, int)
-        for k, v in self.header['@SQ'].items():
-            rname = k.split(':')[1]
-            seqlength = v[0].split(':')[1]
-            for region in tile_region(rname, 1, int(seqlength), width):
+        for rname, seqlength in zip(self._sq_names, self._sq_lengths):
+            for region in tile_region(rname, 1, seqlength, width):
                 yield region
 
     def close(self):
@@ -217,13 +470,19 @@ class Reader(object):
         if self._conn == 'file':
             self.f.close()
         if self._conn == 'proc':
-            self.f.close()
+            self._stop.set()
             self.p.terminate()
+            self._reader.join()
+            self.f.close()
+        if self._conn == 'pysam':
+            self._bam.close()
 
 
 class Writer(object):
-    """ Write SAM/BAM format file from :class:`.Sam` objects. """
-    def __init__(self, f, header=None):
+    """ Write SAM/BAM format file from :class:`.Sam` objects. Records are
+    handed straight to ``f``, which does its own buffering; :meth:`write_many`
+    joins records into blocks of about ``buffer_size`` characters first. """
+    def __init__(self, f, header=None, buffer_size=1 << 20):
         try:
             _, ext = os.path.splitext(f.name)
             if ext == '.bam':
@@ -232,11 +491,13 @@ class Writer(object):
         except AttributeError:  # pipe?
             pass
         self.file = f
-        if self.file.mode == 'a' and self.file.tell() == 0:
+        self._binary = 'b' in getattr(f, 'mode', '')
+        self._flush_at = buffer_size
+        if self.file.mode.startswith('a') and self.file.tell() == 0:
             # We're appending to an empty file. Assume we need a header.
             self._merge_header(header)
             self._header_dict_write()
-        elif self.file.mode == 'a' and self.file.tell() > 0:
+        elif self.file.mode.startswith('a') and self.file.tell() > 0:
             if header:
                 raise NotImplementedError("Updating headers on existing SAM files is not supported.\n")
         else:
@@ -256,11 +517,51 @@ class Writer(object):
         for key, value in self.header.items():
             for k, v in value.items():
                 tags = '\t'.join(v)
-                self.file.write('{key}\t{k}\t{tags}\n'.format(**locals()))
+                line = '{key}\t{k}\t{tags}\n'.format(**locals())
+                self.file.write(line.encode('ascii') if self._binary else line)
 
     def write(self, sam):
-        """ Write the string representation of the ``sam`` :class:`.Sam` object. """
-        self.file.write(str(sam))
+        """ Write the string representation of the ``sam`` :class:`.Sam` object.
+        Files opened in binary mode are written the ASCII bytes. """
+        self.file.write(bytes(sam) if self._binary else str(sam))
+
+    def write_many(self, sams):
+        """ Write every :class:`.Sam` object in the iterable ``sams``. Records
+        are joined into blocks of about ``buffer_size`` characters and encoded
+        in one pass for binary files; all of them are written on return.
+
+        >>> import tempfile
+        >>> out = tempfile.NamedTemporaryFile('w+', suffix='.sam')
+        >>> w = Writer(out)
+        >>> w.write_many([Sam(qname='r1', tags=['NM:i:0']), Sam(qname='r2')])
+        >>> _ = out.seek(0)
+        >>> print(out.read().replace('\\t', ' '))
+        @HD VN:1.0 SO:unknown
+        r1 4 * 0 255 * * 0 0 * * NM:i:0
+        r2 4 * 0 255 * * 0 0 * *
+        <BLANKLINE>
+        >>> w.close()
+        """
+        buf = []
+        size = 0
+        for sam in sams:
+            line = str(sam)
+            buf.append(line)
+            size += len(line)
+            if size >= self._flush_at:
+                self._write_block(buf)
+                buf = []
+                size = 0
+        if buf:
+            self._write_block(buf)
+
+    def _write_block(self, lines):
+        data = ''.join(lines)
+        self.file.write(data.encode('ascii') if self._binary else data)
+
+    def flush(self):
+        """ Flush the underlying file. """
+        self.file.flush()
 
     def close(self):
         self.__exit__()
@@ -289,40 +590,159 @@ class Sam(GenomicOrder):
     # operations that only consume the query
     _cigar_query_only = _cigar_query - _cigar_align
 
+    __slots__ = _SAM_FIELDS + ('_tags', '_line', '_raw', '_tags_cache', '_cigars_cache', '_masked_cache', '_gapped_cache', '_md_cache')
+
     def __init__(self, qname='', flag=4, rname='*', pos=0, mapq=255, cigar='*', rnext='*', pnext=0, tlen=0, seq='*', qual='*', tags=[]):
+        # the integer fields are converted from _raw when first read
+        self._raw = (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual)
         self.qname = qname
-        self.flag = int(flag)
         self.rname = rname
-        self.pos = int(pos)
-        self.mapq = int(mapq)
         self.cigar = cigar
         self.rnext = rnext
-        self.pnext = int(pnext)
-        self.tlen = int(tlen)
         self.seq = seq
         self.qual = qual
-        self._tags = tags
-        self._cache = dict()
+        self._tags = tuple(tags)
+        self._line = self._tags_cache = self._cigars_cache = self._masked_cache = self._gapped_cache = self._md_cache = None
+
+    @classmethod
+    def from_line(cls, line):
+        """ Return a :class:`.Sam` for one SAM ``line`` (without the line
+        terminator). The line is only split into fields when one is first
+        accessed, and ``str()`` returns it verbatim until a field is assigned
+        or a tag is modified.
+
+        >>> x = Sam.from_line('r001\\t99\\tref\\t7\\t30\\t17M\\t=\\t37\\t39\\tTTAGATAAAGGATACTG\\t*\\tNM:i:0')
+        >>> x.pos, x['NM']
+        (7, 0)
+        >>> str(x) == 'r001\\t99\\tref\\t7\\t30\\t17M\\t=\\t37\\t39\\tTTAGATAAAGGATACTG\\t*\\tNM:i:0\\n'
+        True
+        >>> x.pos = 8
+        >>> str(x).split('\\t')[3]
+        '8'
+        """
+        sam = _LineSam.__new__(_LineSam) if cls is Sam else cls.__new__(cls)
+        sam._line = line
+        sam._tags_cache = sam._cigars_cache = sam._masked_cache = sam._gapped_cache = sam._md_cache = None
+        if cls is not Sam:
+            sam._split()
+        return sam
+
+    def __getattr__(self, name):
+        """ Fill an unset slot: an integer field that has not been converted
+        yet, or the tag fields of a record read by :meth:`from_line`.
+
+        >>> x = Sam(pos='7')
+        >>> x.pos, x < Sam(pos=8)
+        (7, True)
+        """
+        column = _SAM_INT_COLUMNS.get(name)
+        if column is not None:
+            value = int(self._raw[column])
+            setattr(self, name, value)
+            return value
+        if name != '_tags' or self._line is None:
+            raise AttributeError(name)
+        fields = self._line.split('\t', 11)
+        self._tags = tags = tuple(fields[11].split('\t')) if len(fields) > 11 else ()
+        return tags
+
+    def _split(self):
+        """ Fill the mandatory field slots from ``self._line`` and return the
+        fields. Integer fields the compiled ``split_sam_line`` did not convert,
+        and the tag fields, are filled when first needed.
+
+        >>> x = Sam.from_line('r1\\t0\\tc1\\t1\\t60\\t4M\\t*\\t0\\t0\\tACGT\\t*\\tNM:i:0\\tMD:Z:4')
+        >>> fields = x._split()
+        >>> x.pos, x._tags
+        (1, ('NM:i:0', 'MD:Z:4'))
+        """
+        fields = _split_line(self._line)
+        if self.__class__ is _LineSam:
+            self.__class__ = Sam
+        self._raw = raw = tuple(fields[:11])
+        if split_sam_line is not None:
+            (self.qname, self.flag, self.rname, self.pos, self.mapq, self.cigar,
+             self.rnext, self.pnext, self.tlen, self.seq, self.qual) = raw
+        else:
+            self.qname, self.rname, self.cigar, self.rnext, self.seq, self.qual = raw[0], raw[2], raw[5], raw[6], raw[9], raw[10]
+        return fields
+
+    def _line_current(self):
+        """ Return True while ``self._line`` still holds the fields and tags. """
+        tags = self._tags_cache
+        if tags is not None and tags.encoded() != '\t'.join(self._tags):
+            return False
+        raw = self._raw
+        if split_sam_line is not None:
+            return raw == (self.qname, self.flag, self.rname, self.pos, self.mapq, self.cigar,
+                           self.rnext, self.pnext, self.tlen, self.seq, self.qual)
+        if (raw[0], raw[2], raw[5], raw[6], raw[9], raw[10]) != (self.qname, self.rname, self.cigar, self.rnext, self.seq, self.qual):
+            return False
+        for i, slot in _SAM_INT_SLOTS:
+            try:
+                value = slot.__get__(self, Sam)
+            except AttributeError:  # neither converted nor assigned
+                continue
+            if value != int(raw[i]):
+                return False
+        return True
+
+    def __getstate__(self):
+        """ Return the field values and parsed tags. Derived caches are rebuilt
+        after unpickling.
+
+        >>> import pickle
+        >>> x = pickle.loads(pickle.dumps(Sam(qname='r001', pos=7, tags=['NM:i:0'])))
+        >>> x.qname, x.pos, x['NM']
+        ('r001', 7, 0)
+        """
+        return (self.qname, self.flag, self.rname, self.pos, self.mapq, self.cigar, self.rnext,
+                self.pnext, self.tlen, self.seq, self.qual, self._tags, self._tags_cache)
+
+    def __setstate__(self, state):
+        (self.qname, self.flag, self.rname, self.pos, self.mapq, self.cigar,
+         self.rnext, self.pnext, self.tlen, self.seq, self.qual, self._tags, self._tags_cache) = state
+        self._line = self._cigars_cache = self._masked_cache = self._gapped_cache = self._md_cache = None
 
     def __str__(self):
         """ Returns the string representation of a SAM entry. Correspondes to one line
-        in the on-disk format of a SAM file. """
-        if self.tags:
-            tag_fields = '\t'.join([encode_tag(tag, self.tags[tag]) for tag in sorted(self.tags.keys())])
-        else:
-            tag_fields = '\t'.join(self._tags)
-        return '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\t{9}\t{10}\t{11}\n'.format(self.qname,
-                                                                                     str(self.flag),
-                                                                                     self.rname,
-                                                                                     str(self.pos),
-                                                                                     str(self.mapq),
-                                                                                     self.cigar,
-                                                                                     self.rnext,
-                                                                                     str(self.pnext),
-                                                                                     str(self.tlen),
-                                                                                     self.seq,
-                                                                                     self.qual,
-                                                                                     tag_fields)
+        in the on-disk format of a SAM file.
+
+        >>> x = Sam(qname='r001', pos=7)
+        >>> x.tlen = '5'
+        >>> str(x).split('\\t')[3:9]
+        ['7', '255', '*', '*', '0', '5']
+        """
+        if self._line is not None and self._line_current():
+            return self._line + '\n'
+        tag_fields = self._tag_fields()
+        if tag_fields:
+            tag_fields = '\t' + tag_fields
+        return _SAM_FMT % (self.qname, self.flag, self.rname, self.pos, self.mapq, self.cigar,
+                           self.rnext, self.pnext, self.tlen, self.seq, self.qual, tag_fields)
+
+    def __bytes__(self):
+        """ Returns the SAM line as ASCII bytes, for writing to binary files. """
+        return str(self).encode('ascii')
+
+    def _tag_fields(self):
+        """ Returns the tags as tab-delimited ``TAG:TYPE:data`` fields. Tags
+        are written back verbatim, in their original order, until they are
+        modified; after that they are sorted by tag name.
+
+        >>> x = Sam(tags=['ZZ:Z:xyz', 'NM:i:0'])
+        >>> x['NM']
+        0
+        >>> x._tag_fields()
+        'ZZ:Z:xyz\\tNM:i:0'
+        >>> x['NM'] = 1
+        >>> x._tag_fields()
+        'NM:i:1\\tZZ:Z:xyz'
+        """
+        if self._tags_cache is not None:
+            return self._tags_cache.encoded()
+        return '\t'.join(self._tags)
+
     def __repr__(self):
         return "Sam({0}:{1}:{2})".format(self.rname, self.pos, self.qname)
 
@@ -334,7 +754,7 @@ class Sam(GenomicOrder):
         >>> len(x)
         16
         """
-        return sum(c[0] for c in self.cigars if c[1] in self._cigar_ref)
+        return sum([n for n, _, m in self.cigars_masked if m & 1])
 
     def __getitem__(self, tag):
         """ Retreives the SAM tag named "tag" as a tuple: (tag_name, data). The
@@ -359,6 +779,22 @@ class Sam(GenomicOrder):
         """
         self.tags[tag] = data
 
+    def _get_tag(self, tag):
+        """ Return the data for a single tag, decoding only that tag if the
+        tags have not already been parsed.
+
+        >>> x = Sam(tags=['NM:i:0', 'MD:Z:75'])
+        >>> x._get_tag('MD')
+        '75'
+        """
+        if self._tags_cache is not None:
+            return self._tags_cache[tag]
+        prefix = tag + ':'
+        for field in self._tags:
+            if field.startswith(prefix):
+                return decode_tag(field)[2]
+        raise KeyError(tag)
+
     def index_of(self, pos):
         """ Return the relative index within the alignment from a genomic position 'pos' """
         i = pos - self.pos
@@ -374,17 +810,8 @@ class Sam(GenomicOrder):
             return default_value
 
     def cigar_split(self):
-        # https://github.com/brentp/bwa-meth
-        if self.cigar == "*":
-            yield (0, None)
-            return
-        cig_iter = groupby(self.cigar, lambda c: c.isdigit())
-        for _, n in cig_iter:
-            op = int("".join(n)), "".join(next(cig_iter)[1])
-            if op[1] in self._valid_cigar:
-                yield op
-            else:
-                raise ValueError("CIGAR operation %s in record %s is invalid." % (op[1], self.qname))
+        for op in self.cigars:
+            yield op
 
     def gapped(self, attr, gap_char='-'):
         """ Return a :class:`.Sam` sequence attribute or tag with all
@@ -400,6 +827,8 @@ class Sam(GenomicOrder):
         >>> x = Sam(*'r001\t99\tref\t7\t30\t8M2I4M1D3M\t=\t37\t39\tTTAGATAAAGGATACTG\t*'.split(), tags=['ZM:Z:.........M....M.M'])
         >>> x.gapped('ZM')
         '............-M.M'
+        >>> Sam(cigar='10M', seq='ACGT', qual='IIII').gapped('seq')
+        'ACGT'
         """
         try:
             ungapped = getattr(self, attr)
@@ -407,44 +836,111 @@ class Sam(GenomicOrder):
             ungapped = self[attr]  # get dictionary key (tag) if attribute is missing
         if len(ungapped) != len(self.seq):
             raise ValueError("The length of the '%s' attribute is not equal to the length of Sam.seq!" % attr)
-        gapped = []
-        i = 0
-        for n, t in self.cigars:
-            if t in self._cigar_align:
-                gapped.extend(ungapped[i:i + n])
+        if gapped_c is not None:
+            return gapped_c(self.cigars, ungapped.encode('ascii'), ord(gap_char)).decode('ascii')
+        ungapped = ungapped.encode('ascii')
+        gap_char = gap_char.encode('ascii')
+        gapped = bytearray(len(self))
+        i = j = 0
+        for n, _, m in self.cigars_masked:
+            if m == 3:
+                run = ungapped[i:i + n]
+                gapped[j:j + len(run)] = run
                 i += n
-            elif t in self._cigar_ref_only:
-                gapped.extend([gap_char] * n)
-            elif t in self._cigar_query_only:
+                j += len(run)
+            elif m == 1:
+                gapped[j:j + n] = gap_char * n
+                j += n
+            elif m == 2:
                 i += n
-            elif t in self._cigar_no_align:
-                pass
-        return ''.join(gapped)
+        if j < len(gapped):  # aligned runs past the end of the query are truncated
+            del gapped[j:]
+        return gapped.decode('ascii')
+
+    def _gapped_pair(self, seq_gap='-', qual_gap='~'):
+        """ Return ``Sam.seq`` and ``Sam.qual`` gapped as in :meth:`gapped`, as a
+        pair of bytes built from a single walk over the CIGAR. The gapped quality
+        is None if ``Sam.qual`` is absent.
+
+        >>> x = Sam(*'r001\t99\tref\t7\t30\t8M2I4M1D3M\t=\t37\t39\tTTAGATAAAGGATACTG\t*'.split())
+        >>> x._gapped_pair()[0] == b'TTAGATAAGATA-CTG'
+        True
+        """
+        key = (seq_gap, qual_gap)
+        if self._gapped_cache is not None and self._gapped_cache[0] == key:
+            return self._gapped_cache[1]
+        seq = self.seq.encode('ascii')
+        if gapped_c is not None:
+            qual = None
+            if len(self.qual) == len(self.seq):
+                qual = gapped_c(self.cigars, self.qual.encode('ascii'), ord(qual_gap))
+            pair = (gapped_c(self.cigars, seq, ord(seq_gap)), qual)
+            self._gapped_cache = (key, pair)
+            return pair
+        length = len(self)
+        gapped_seq = bytearray(length)
+        seq_gap = seq_gap.encode('ascii')
+        if len(self.qual) == len(self.seq):
+            qual = self.qual.encode('ascii')
+            gapped_qual = bytearray(length)
+            qual_gap = qual_gap.encode('ascii')
+        else:
+            qual = gapped_qual = None
+        i = j = 0
+        for n, _, m in self.cigars_masked:
+            if m == 3:
+                run = seq[i:i + n]
+                k = len(run)
+                gapped_seq[j:j + k] = run
+                if qual is not None:
+                    gapped_qual[j:j + k] = qual[i:i + n]
+                i += n
+                j += k
+            elif m == 1:
+                gapped_seq[j:j + n] = seq_gap * n
+                if qual is not None:
+                    gapped_qual[j:j + n] = qual_gap * n
+                j += n
+            elif m == 2:
+                i += n
+        if j < length:  # aligned runs past the end of the query are truncated
+            del gapped_seq[j:]
+            if qual is not None:
+                del gapped_qual[j:]
+        pair = (bytes(gapped_seq), None if qual is None else bytes(gapped_qual))
+        self._gapped_cache = (key, pair)
+        return pair
 
     def parse_md(self):
         """ Return the ungapped reference sequence from the MD tag, if present.
+
+        >>> x = Sam(*'r001\t99\tref\t7\t30\t8M2I4M1D3M\t=\t37\t39\tTTAGATAAAGGATACTG\t*'.split(), tags=['MD:Z:3C4A3^T3'])
+        >>> ''.join(x.parse_md())
+        'TTACATAAAATATCTG'
         """
+        return list(self._md_ref().decode('ascii'))
+
+    def _md_ref(self):
+        """ Return the gapped reference sequence from the MD tag as bytes. Each
+        run of mismatched or deleted bases is copied in with one slice assignment.
+        """
+        if self._md_cache is not None:
+            return self._md_cache
         try:
-            return self._cache['parse_md']
-        except KeyError:
-            pass
-        try:
-            md = self['MD']
+            md = self._get_tag('MD')
         except KeyError:
             raise KeyError('MD tag not found in SAM record.')
-        ref_seq = list(self.gapped('seq'))
-        md_match = re.findall(r"([0-9]+)\^?([A-Z]+)?", md)
+        ref_seq = bytearray(self._gapped_pair()[0])
         ref_seq_i = 0
-        for i, b in md_match:
+        for i, b in _MD_RE.findall(md.encode('ascii')):
             ref_seq_i += int(i)
-            for mismatch in b:
-                try:
-                    ref_seq[ref_seq_i] = mismatch
-                except IndexError:
-                    raise IndexError(locals())
-                ref_seq_i += 1
-        self._cache['parse_md'] = ref_seq
-        return ref_seq
+            if b:
+                if ref_seq_i + len(b) > len(ref_seq):
+                    raise IndexError("MD tag %s in record %s is longer than the alignment." % (md, self.qname))
+                ref_seq[ref_seq_i:ref_seq_i + len(b)] = b
+                ref_seq_i += len(b)
+        self._md_cache = bytes(ref_seq)
+        return self._md_cache
 
     @property
     def cigars(self):
@@ -454,11 +950,29 @@ class Sam(GenomicOrder):
         >>> x.cigars
         ((8, 'M'), (2, 'I'), (4, 'M'), (1, 'D'), (3, 'M'))
         """
-        try:
-            return self._cache['cigars']
-        except KeyError:
-            self._cache['cigars'] = tuple(self.cigar_split())
-            return self._cache['cigars']
+        if self._cigars_cache is None:
+            cigar = self.cigar
+            if cigar == "*":
+                self._cigars_cache = ((0, None),)
+                return self._cigars_cache
+            ops = _CIGAR_RE.findall(cigar)
+            if sum(len(n) + len(t) for n, t in ops) != len(cigar):
+                raise ValueError("CIGAR string %s in record %s is invalid." % (cigar, self.qname))
+            self._cigars_cache = tuple([(int(n), t) for n, t in ops])
+        return self._cigars_cache
+
+    @property
+    def cigars_masked(self):
+        """ Returns ``Sam.cigars`` with the ``_OP_MASK`` class of each operation
+        appended, for walking the alignment without set lookups.
+
+        >>> x = Sam(cigar='4M1D3M4S')
+        >>> x.cigars_masked
+        ((4, 'M', 3), (1, 'D', 1), (3, 'M', 3), (4, 'S', 2))
+        """
+        if self._masked_cache is None:
+            self._masked_cache = tuple([(n, t, _OP_MASK[ord(t)] if t else 0) for n, t in self.cigars])
+        return self._masked_cache
 
     @property
     def tags(self):
@@ -468,11 +982,11 @@ class Sam(GenomicOrder):
         >>> sorted(x.tags.items(), key=lambda x: x[0])
         [('MD', '75'), ('NH', 1), ('NM', 0), ('RG', '1'), ('XB', 'cttacgttaagagttaac'), ('XU', 'cgttttaa')]
         """
-        try:
-            return self._cache['tags']
-        except KeyError:
-            self._cache['tags'] = parse_sam_tags(self._tags)
-            return self._cache['tags']
+        if self._tags_cache is None:
+            tags = parse_sam_tags(self._tags)
+            tags._encoded = '\t'.join(self._tags)  # unmodified tags keep their order
+            self._tags_cache = tags
+        return self._tags_cache
 
     @property
     def paired(self):
@@ -519,9 +1033,86 @@ class Sam(GenomicOrder):
             return self.qname
 
 
+class _LineSam(Sam):
+    """ A :class:`.Sam` read by :meth:`Sam.from_line` whose line has not been
+    split yet. Reading or assigning a field splits the line and turns the
+    record into a plain :class:`.Sam`, whose field reads are slot reads. """
+    __slots__ = ()
+
+    def _line_current(self):
+        tags = self._tags_cache
+        return tags is None or tags.encoded() == '\t'.join(self._tags)
+
+    def __reduce__(self):
+        if self._line_current():
+            return (Sam.from_line, (self._line,))
+        return (_restore_sam, (self.__getstate__(),))
+
+
+def _line_field(column, slot):
+    def get(self):
+        fields = self._split()
+        if split_sam_line is None and column in _SAM_INT_INDEX:
+            value = int(fields[column])
+            slot.__set__(self, value)
+            return value
+        return fields[column]
+
+    def set(self, value):
+        self._split()
+        slot.__set__(self, value)
+    return property(get, set)
+
+
+for _column, _name in enumerate(_SAM_FIELDS):
+    setattr(_LineSam, _name, _line_field(_column, Sam.__dict__[_name]))
+
+# integer field slots, checked without converting them
+_SAM_INT_SLOTS = tuple((i, Sam.__dict__[name]) for i, name in enumerate(_SAM_FIELDS) if name in _SAM_INT_FIELDS)
+
+
+def _restore_sam(state):
+    """ Unpickle a modified :class:`_LineSam` as a plain :class:`.Sam`. """
+    sam = Sam.__new__(Sam)
+    sam.__setstate__(state)
+    return sam
+
+
+# column indices of the integer fields
+_SAM_INT_COLUMNS = dict((name, i) for i, name in enumerate(_SAM_FIELDS) if name in _SAM_INT_FIELDS)
+_SAM_INT_INDEX = tuple(sorted(_SAM_INT_COLUMNS.values()))
+
+
+def _split_line(line):
+    """ Return the eleven mandatory fields of the SAM ``line`` followed by the
+    tag fields as one string. The compiled ``split_sam_line``, when present,
+    also converts the integer fields and otherwise agrees with ``str.split``:
+
+    >>> line = 'r1\\t0\\tc1\\t1\\t60\\t4M\\t*\\t0\\t0\\tACGT\\t*\\tNM:i:0\\tMD:Z:4'
+    >>> fields = line.split('\\t', 11)
+    >>> split_sam_line is None or split_sam_line(line) == [int(x) if i in _SAM_INT_INDEX else x for i, x in enumerate(fields)]
+    True
+    >>> len(_split_line(line))
+    12
+    """
+    if split_sam_line is not None:
+        fields = split_sam_line(line)
+    else:
+        fields = line.split('\t', 11)
+    if len(fields) < 11:
+        raise ValueError("SAM record %s has fewer than 11 fields." % fields[0])
+    return fields
+
+
 def parse_sam_tags(tagfields):
     """ Return a dictionary containing the tags """
-    return dict([(tag, data) for tag, dtype, data in [decode_tag(x) for x in tagfields]])
+    parsed = {}
+    for field in tagfields:
+        tag, data_type, data = field.split(':', 2)
+        parsed[tag] = _TAG_CONV.get(data_type, _unsupported_tag)(data)
+    tags = _TagDict(parsed)
+    tags._encoded = None
+    return tags
 
 
 def encode_tag(tag, data):
@@ -531,6 +1122,10 @@ def encode_tag(tag, data):
     >>> encode_tag('YM', '#""9O"1@!J')
     'YM:Z:#""9O"1@!J'
     """
+    try:
+        return _ENCODERS[data.__class__] % (tag, data)
+    except KeyError:
+        pass
     if isinstance(data, string_types):
         data_type = 'Z'
     elif isinstance(data, int):
@@ -545,7 +1140,7 @@ def encode_tag(tag, data):
 
 def decode_tag(tag_string):
     """ Parse a SAM format tag to a (tag, type, data) tuple. Python object
-    types for data are set using the type code. Supported type codes are: A, i, f, Z, H, B
+    types for data are set using the type code. Supported type codes are: A, i, f, Z
 
     >>> decode_tag('YM:Z:#""9O"1@!J')
     ('YM', 'Z', '#""9O"1@!J')
@@ -553,28 +1148,22 @@ def decode_tag(tag_string):
     ('XS', 'i', 5)
     >>> decode_tag('XF:f:100.5')
     ('XF', 'f', 100.5)
+    >>> decode_tag('XA:Z:chr1:+100')
+    ('XA', 'Z', 'chr1:+100')
     """
-    try:
-        tag, data_type, data = tag_string.split(':')
-    except ValueError:
-        match = re.match(r'([A-Z]{2}):([iZfHB]):(\S+)', tag_string)
-        tag = match.group(1)
-        data_type = match.group(2)
-        data = match.group(3)
-    if data_type == 'i':
-        return (tag, data_type, int(data))
-    elif data_type == 'Z':
-        return (tag, data_type, data)
-    elif data_type == 'f':
-        return (tag, data_type, float(data))
-    elif data_type == 'A':  # this is just a special case of a character
-        return (tag, data_type, data)
-    elif data_type == 'H':
-        raise NotImplementedError("Hex array SAM tags are currently not parsed.")
-    elif data_type == 'B':
-        raise NotImplementedError("Byte array SAM tags are currently not parsed.")
-    else:
-        raise NotImplementedError("Tag {0} cannot be parsed.".format(tag_string))
+    tag, data_type, data = tag_string.split(':', 2)
+    return (tag, data_type, _TAG_CONV.get(data_type, _unsupported_tag)(data))
+
+
+def _unsupported_tag(data):
+    raise NotImplementedError("Tag data {0} cannot be parsed. Supported type codes are A, i, f, Z.".format(data))
+
+
+def segment_to_sam(segment):
+    """ Build a :class:`.Sam` from a ``pysam.AlignedSegment``. The record is
+    read from htslib's SAM text for the segment, so fields and tags are only
+    parsed when they are accessed. """
+    return Sam.from_line(segment.to_string())
 
 
 def tile_region(rname, start, end, step):
@@ -592,13 +1181,61 @@ def tile_region(rname, start, end, step):
     if start < end:
         yield '%s:%d-%d' % (rname, start, end)
 
+def bam_index_exists(bamfile):
+    """ Return True if a BAI or CSI index exists for ``bamfile``. """
+    root, _ = os.path.splitext(bamfile)
+    for index in (bamfile + '.bai', bamfile + '.csi', root + '.bai', root + '.csi'):
+        if os.path.exists(index):
+            return True
+    return False
+
+
+def _read_blocks(stream, blocks, stop, chunk_size=_PIPE_BUFSIZE):
+    """ Read ``stream`` ``chunk_size`` bytes at a time and put lists of
+    decoded lines, without line terminators, on the ``blocks`` queue. None is
+    put at the end of the stream; an exception is put in its place if reading
+    fails. Returns early once ``stop`` is set. """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remainder = ''
+    end = None
+    try:
+        while not stop.is_set():
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + decoder.decode(chunk)).split('\n')
+            remainder = lines.pop()
+            if lines and not _put_block(blocks, lines, stop):
+                return
+        if remainder:
+            _put_block(blocks, [remainder], stop)
+    except Exception as e:
+        end = e
+    _put_block(blocks, end, stop)
+
+
+def _put_block(blocks, block, stop):
+    """ Put ``block`` on the ``blocks`` queue, giving up if ``stop`` is set
+    while the queue is full. Returns True if the block was queued. """
+    while not stop.is_set():
+        try:
+            blocks.put(block, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
 def bam_read_count(bamfile, samtools_path="samtools"):
     """ Return a tuple of the number of mapped and unmapped reads in a BAM file """
-    p = Popen([samtools_path, 'idxstats', bamfile], stdout=PIPE)
+    p = Popen([samtools_path, 'idxstats', bamfile], stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        raise OSError("samtools idxstats failed for {0}: {1}".format(bamfile, err.decode('utf-8', 'replace').strip()))
     mapped = 0
     unmapped = 0
-    for line in p.stdout:
-        rname, rlen, nm, nu = line.rstrip().split()
+    for line in out.splitlines():
+        rname, rlen, nm, nu = line.split()
         mapped += int(nm)
         unmapped += int(nu)
     return (mapped, unmapped)